@@ -0,0 +1,39 @@
+"""Read sample sheets shared by process_metadata.py and results_report.py."""
+
+from importlib.util import find_spec
+import pandas as pd
+
+#pandas gained the calamine Excel engine in 2.2, older releases fall back to openpyxl
+EXCEL_ENGINE = "calamine" if tuple(int(part) for part in pd.__version__.split(".")[:2]) >= (2, 2) and find_spec("python_calamine") else "openpyxl"
+
+def read_excel_columns(file, ncols, dtype=None):
+    """
+    Read the first columns of the first sheet of an Excel file
+
+    Uses calamine when available, otherwise streams the rows through openpyxl in
+    read-only mode rather than building the full workbook. Blank rows are skipped
+    on both paths.
+
+    Args:
+        file (str): path to the Excel file
+        ncols (int): number of leading columns to read
+        dtype (dict): column dtypes, skipping inference for those columns
+
+    Returns:
+        pandas.DataFrame: parsed table
+    """
+    if EXCEL_ENGINE == "calamine":
+        table = pd.read_excel(file, usecols=range(0,ncols), dtype=dtype, engine=EXCEL_ENGINE)
+        # read_excel keeps blank rows as empty rows, drop them as the openpyxl path does
+        return table.dropna(how='all').reset_index(drop=True)
+    from openpyxl import load_workbook
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = [row for row in workbook.worksheets[0].iter_rows(values_only=True, max_col=ncols)
+                if any(value is not None for value in row)]
+    finally:
+        workbook.close()
+    if not rows:
+        raise ValueError("{0} has no header row".format(file))
+    table = pd.DataFrame(rows[1:], columns=rows[0])
+    return table.astype(dtype) if dtype else table
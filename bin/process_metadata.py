@@ -2,25 +2,26 @@
 
 import argparse
 import shutil
-import pandas as pd
 import os.path
-import csv
+from excel_reader import read_excel_columns
 
-def process_metadata(file):
+META_DTYPES = {"Barcode": "string", "Status": "category"}
+
+def process_metadata(file, exclude_statuses=('discontinued',)):
     """process metadata file to create list of barcodes and names of positive and negative controls"""
-    meta=pd.read_excel(file, usecols=range(0,6))
-    barcodes=[]
-    for index, row in meta.iterrows():
-        if row['Status'] not in ['discontinued']:
-            barcodes.append(row['Barcode'])
+    meta=read_excel_columns(file, 6, META_DTYPES)
+    barcodes=meta.loc[~meta['Status'].isin(exclude_statuses), 'Barcode'].tolist()
+
+    status_set=set(meta['Status'].cat.categories)
+    status_to_barcode=dict(zip(meta['Status'], meta['Barcode']))
 
-    if 'positive control' in set(meta['Status']):
-        positive_ctrl='rel_abundance_'+ meta.loc[meta['Status'] == 'positive control', 'Barcode'].item() + '_S.csv'
+    if 'positive control' in status_set:
+        positive_ctrl='rel_abundance_'+ status_to_barcode['positive control'] + '_S.csv'
     else:
         positive_ctrl="none"
 
-    if 'negative control' in set(meta['Status']):
-        negative_ctrl='rel_abundance_'+ meta.loc[meta['Status'] == 'negative control', 'Barcode'].item() + '_S.csv'
+    if 'negative control' in status_set:
+        negative_ctrl='rel_abundance_'+ status_to_barcode['negative control'] + '_S.csv'
     else: 
         negative_ctrl="none"
 
@@ -31,14 +32,14 @@ def output_meta(pos, neg):
     if os.path.exists(pos):
         shutil.copyfile(pos, "positive_control.csv")
     else:
-        with open('positive_control.csv', 'w') as file:
+        with open('positive_control.csv', 'w', buffering=1<<20) as file:
             pass
         print("positive control not provided")
 
     if os.path.exists(neg):
         shutil.copyfile(neg, "negative_control.csv")
     else:
-        with open('negative_control.csv', 'w') as file:
+        with open('negative_control.csv', 'w', buffering=1<<20) as file:
             pass
         print("negative control not provided")
 
@@ -50,15 +51,19 @@ def main():
     parser.add_argument(
         "--metatable", required=True,
         help="Table with information on positive and negative controls")
+    parser.add_argument(
+        "--exclude-statuses", nargs='+', default=['discontinued'],
+        help="Sample statuses left out of barcodes.csv (quote values containing spaces)")
+    parser.add_argument(
+        "--write-barcodes", action='store_true',
+        help="Write the list of included barcodes to barcodes.csv")
     args = parser.parse_args()
 
-    positive,negative,barcodes=process_metadata(args.metatable)
+    positive,negative,barcodes=process_metadata(args.metatable, args.exclude_statuses)
 
-    barcodes_rows=zip(barcodes)
-    with open("barcodes.csv", "w") as f:
-        writer = csv.writer(f)
-        for row in barcodes_rows:
-            writer.writerow(row)
+    if args.write_barcodes:
+        with open("barcodes.csv", "w", buffering=1<<20) as f:
+            f.write("".join(str(barcode) + "\n" for barcode in barcodes))
 
     output_meta(positive, negative)
     
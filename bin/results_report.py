@@ -3,17 +3,14 @@
 """Create results report."""
 
 import argparse
-from concurrent.futures import process
-from curses import meta
-import uuid
-from aplanat import report
+import csv
+import itertools
 import pandas as pd
 import os
 import numpy as np
-from jinja2 import Template
-from collections import OrderedDict
-import pkg_resources
-from bokeh.resources import INLINE
+from excel_reader import read_excel_columns
+
+INFO_DTYPES = {"Barcode": "string", "Status": "category"}
 
 def read_patient_info(file, barcode):
     """
@@ -27,24 +24,19 @@ def read_patient_info(file, barcode):
         list: list of pandas Series with patient info
     """
     #funtion parsing CSV patient file and looking up info for relevant barcode
-    info=pd.read_excel(file, usecols=range(0,11))
+    info=read_excel_columns(file, 11, INFO_DTYPES)
     #return row with a barcode as a Series
     if barcode=="discontinued":
         relevant_row=[]
         relevant_rows=info.loc[info['Status'] == barcode]
-        for index,row in relevant_rows.iterrows():
-            single_row=row.transpose()
-            single_df=single_row.reset_index()
-            single_df.columns=['Metadata', 'Sample Information']
-            relevant_row.append(single_df)
+        #one Metadata column shared by every patient table
+        metadata=relevant_rows.columns.to_numpy()
+        for values in relevant_rows.to_numpy():
+            relevant_row.append(pd.DataFrame({'Metadata': metadata, 'Sample Information': values}))
     else:
-        relevant_rows=info.loc[info['Barcode'] == barcode]
-        #move row names into a column
-        relevant_row=relevant_rows.transpose()
-        relevant_row.index.name = 'Metadata'
-        relevant_row.reset_index(inplace=True)
-        #rename columns
-        relevant_row.columns=['Metadata', 'Sample Information']
+        matched=info[info['Barcode'].to_numpy(dtype=object, na_value=None) == barcode]
+        #column names become the Metadata column
+        relevant_row=pd.DataFrame({'Metadata': info.columns.to_numpy(), 'Sample Information': matched.to_numpy()[0]})
     return relevant_row
 
 def read_abundance_results(file):
@@ -58,19 +50,43 @@ def read_abundance_results(file):
         pandas.DataFrame: top 3 abundance results
     """
     # The abundance results file is a CSV file
-    abundance_results = pd.read_csv(file)
+    abundance_results = pd.read_csv(file, dtype={0: "string", 1: "float64"})
     
     # Rename the columns
     abundance_results.columns = ['Detected Species', 'Relative Abundance (%)', 'Number of Reads']
     
     # Round the abundance results
-    abundance_results['Relative Abundance (%)'] = abundance_results['Relative Abundance (%)'].apply(np.around)
+    abundance_results['Relative Abundance (%)'] = np.round(abundance_results['Relative Abundance (%)'].to_numpy())
     
     # Return the top 3 abundance results
     abundance_results_t3 = abundance_results.head(n=3)
     
     return abundance_results_t3
 
+def read_control_results(file):
+    """
+    Read the top 3 results of a control abundance file with the csv module
+
+    Control files are small and already sorted by abundance, so only the first
+    three data rows are parsed and the pandas CSV engine is skipped.
+
+    Args:
+        file (path): path to the control abundance results file
+
+    Returns:
+        pandas.DataFrame: top 3 abundance results
+    """
+    with open(file, newline='') as f:
+        # short rows are padded and extra columns dropped, as pandas does for the first three columns
+        rows = [(row + ['', ''])[:3] for row in itertools.islice(csv.reader(f), 1, 4)]
+    names, abundances, reads = zip(*rows) if rows else ((), (), ())
+
+    # empty fields become NaN and whole read counts stay integers, matching read_abundance_results
+    return pd.DataFrame({
+        'Detected Species': pd.array([name or None for name in names], dtype="string"),
+        'Relative Abundance (%)': np.round(pd.to_numeric(pd.Series(abundances, dtype=object), errors='coerce').to_numpy(dtype="float64")),
+        'Number of Reads': pd.to_numeric(pd.Series(reads, dtype=object), errors='coerce')})
+
 def process_controls(controls):
     """
     Process controls files
@@ -83,15 +99,15 @@ def process_controls(controls):
     """
     for i in controls:
         if "positive" in i:
-            if os.stat(i).st_size == 0:
+            if os.path.getsize(i) == 0:
                 positive = None
             else:
-                positive = read_abundance_results(i)
+                positive = read_control_results(i)
         else:
-            if os.stat(i).st_size == 0:
+            if os.path.getsize(i) == 0:
                 negative = None
             else:
-                negative = read_abundance_results(i)
+                negative = read_control_results(i)
 
     return positive,negative
 
@@ -144,15 +160,19 @@ def main():
         "--seq_start", default='unknown',
         help="Start time of the sequencing run")
     args = parser.parse_args()
+
+    # aplanat pulls in bokeh, so only import it once arguments are valid
+    from aplanat import report
+
     if args.barcode=="discontinued":
 
         metadata_table_list=read_patient_info(args.info, args.barcode)
                 
         for patient in metadata_table_list:
             # Restructure the metadata table
-            restructured=[]
-            for index, row in patient.iloc[[0,2,1,4,6,7,10]].iterrows():
-                restructured.append(": ".join([str(row['Metadata']), str(row['Sample Information'])]))
+            meta_keys=patient['Metadata'].tolist()
+            meta_values=patient['Sample Information'].tolist()
+            restructured=[": ".join([str(meta_keys[i]), str(meta_values[i])]) for i in [0,2,1,4,6,7,10]]
             restructured.insert(4, " ".join(["Sequencing start:", args.seq_start]))
             rest_df=pd.DataFrame(list(zip(restructured[:4],restructured[4:])), columns=['Sample Information', 'Time Stamps'])
 
@@ -186,14 +206,18 @@ def main():
             reprt.write("patient_report_" + str(patient.iloc[1,1]) + ".html")
     else:        
         metadata_table=read_patient_info(args.info, args.barcode)
-        restructured=[]
-        for index, row in metadata_table.iloc[[0,2,1,4,6,7,10]].iterrows():
-            restructured.append(": ".join([str(row['Metadata']), str(row['Sample Information'])]))
+        meta_keys=metadata_table['Metadata'].tolist()
+        meta_values=metadata_table['Sample Information'].tolist()
+        meta_dict=dict(zip(meta_keys, meta_values))
+        patient_id=meta_values[0]
+        sample_barcode=meta_values[1]
+
+        restructured=[": ".join([str(meta_keys[i]), str(meta_values[i])]) for i in [0,2,1,4,6,7,10]]
         restructured.insert(4, " ".join(["Sequencing start:", args.seq_start]))
         rest_df=pd.DataFrame(list(zip(restructured[:4],restructured[4:])), columns=['Sample Information', 'Time Stamps'])
 
         # Create the title for the report
-        title="Patient " + metadata_table.iloc[0,1] + " Report"
+        title="Patient " + patient_id + " Report"
 
         if args.infile == "input.1":
             results_table = None
@@ -222,7 +246,7 @@ def main():
         Total reads in this sample: {0}
         '''.format(args.reads_count))
 
-        assay_type=metadata_table.loc[metadata_table['Metadata'] == 'Assay', 'Sample Information'].iloc[0]
+        assay_type=meta_dict['Assay']
 
         if assay_type == '16S':
             database_info="16s bacterial sequencing results were compared against 16S & 18S database, build 18 Jan 2022."
@@ -254,7 +278,7 @@ def main():
             comment+=10
             section.markdown('''
             Total reads in negative control: {0} 
-            '''.format(negative['Number of Reads'].sum()))
+            '''.format(int(np.nansum(negative['Number of Reads'].to_numpy()))))
 
             section.table(negative, classes='larger-first-column')
         else:
@@ -271,7 +295,7 @@ def main():
             comment+=1
             section.markdown('''
             Total reads in positive control: {0}
-            '''.format(positive['Number of Reads'].sum()))
+            '''.format(int(np.nansum(positive['Number of Reads'].to_numpy()))))
             
             section.table(positive, classes='larger-first-column')
         else:
@@ -298,10 +322,10 @@ def main():
         barcoding_kit=args.kit
         print(barcoding_kit)
         demux_method=args.demux
-        species_database=metadata_table['Sample Information'].iloc[4]
+        species_database=meta_values[4]
         clustering_size=args.clustering_size
 
-        run_params=pd.DataFrame(list(zip(['Run ID: '+str(run_id), 'Barcoding kit: '+str(barcoding_kit), 'Demultiplex method: '+str(demux_method)], ['Species database: '+str(species_database), 'Clustering size: '+str(clustering_size), 'Sample barcode: '+str(metadata_table.iloc[1,1])])), columns=['GridIon properties', 'NanoCLUST properties'])
+        run_params=pd.DataFrame(list(zip(['Run ID: '+str(run_id), 'Barcoding kit: '+str(barcoding_kit), 'Demultiplex method: '+str(demux_method)], ['Species database: '+str(species_database), 'Clustering size: '+str(clustering_size), 'Sample barcode: '+str(sample_barcode)])), columns=['GridIon properties', 'NanoCLUST properties'])
         #run_params.reset_index(drop=True, inplace=True)
 
         section.markdown('''
@@ -313,10 +337,10 @@ def main():
         Sequencing data was processed and analysed using a custom nanoclust pipeline.
         {6}
 
-        '''.format(run_id, barcoding_kit, demux_method, species_database, clustering_size, metadata_table.iloc[1,1], database_info))
+        '''.format(run_id, barcoding_kit, demux_method, species_database, clustering_size, sample_barcode, database_info))
 
         #write report
-        reprt.write(args.output + "_" + str(metadata_table.iloc[1,1]) + ".html")
+        reprt.write(args.output + "_" + str(sample_barcode) + ".html")
 
 
 if __name__ == "__main__":
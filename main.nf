@@ -838,7 +838,7 @@ if(params.generateReports){
         info_file=params.experimentInfo
 
         """
-        process_metadata.py --metatable ${samplesheet}
+        process_metadata.py --metatable ${samplesheet} --exclude-statuses discontinued --write-barcodes
         """
         
     }
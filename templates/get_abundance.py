@@ -1,44 +1,129 @@
 #!/usr/bin/env python
 
 import pandas as pd
-from functools import reduce
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import numpy as np
+import os
+import atexit
+import logging
+from concurrent.futures import ThreadPoolExecutor
+logger = logging.getLogger(__name__)
 #https://unipept.ugent.be/apidocs/taxonomy
-
-def get_taxname(tax_id,tax_level):
-    tags = {"S": "species_name","G": "genus_name","F": "family_name","O":'order_name', "C": "class_name"}
-    tax_level_tag = tags[tax_level]
-    #Avoids pipeline crash due to "nan" classification output. Thanks to Qi-Maria from Github
-    if str(tax_id) == "nan":
-        tax_id = 1
-    
-    path = 'http://api.unipept.ugent.be/api/v1/taxonomy.json?input[]=' + str(int(tax_id)) + '&extra=true&names=true'
-    complete_tax = requests.get(path).text
-
+UNIPEPT_TAXONOMY = 'https://api.unipept.ugent.be/api/v1/taxonomy.json'
+UNIPEPT_TAGS = {"S": "species_name","G": "genus_name","F": "family_name","O":'order_name', "C": "class_name"}
+#Records are kept until the file is deleted, delete it to pick up Unipept taxonomy updates
+UNIPEPT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "nanoclust", "unipept.json")
+UNIPEPT_TIMEOUT = 30
+#Concurrent single-id lookups, matched to the connection pool size to stay polite to Unipept
+UNIPEPT_WORKERS = 8
+
+#One keep-alive connection pool for every Unipept call, retrying transient gateway errors
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=UNIPEPT_WORKERS,
+                                      max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])))
+
+def load_unipept_cache():
+    #Unipept taxonomy records from previous runs, keyed by taxon id
+    try:
+        with open(UNIPEPT_CACHE_FILE) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+unipept_cache = load_unipept_cache()
+unipept_cache_size = len(unipept_cache)
+
+@atexit.register
+def save_unipept_cache():
+    if len(unipept_cache) == unipept_cache_size:
+        return
+    try:
+        os.makedirs(os.path.dirname(UNIPEPT_CACHE_FILE), exist_ok=True)
+        #parallel barcode tasks share the file, so records saved by tasks that finished
+        #since this one started are merged in; only simultaneous saves can still drop records
+        merged = load_unipept_cache()
+        merged.update(unipept_cache)
+        #write a private file and swap it in so readers never see a partial file
+        partial = UNIPEPT_CACHE_FILE + "." + str(os.getpid())
+        with open(partial, "w") as cache_file:
+            json.dump(merged, cache_file)
+        os.replace(partial, UNIPEPT_CACHE_FILE)
+    except OSError:
+        pass
+
+def name_from_record(record, tax_level_tag, query_id):
     #Checks for API correct response (field containing the tax name). Thanks to devinbrown from Github
     try:
-        name = json.loads(complete_tax)[0][tax_level_tag]
+        name = record[tax_level_tag]
         if name == "":
-            name = json.loads(complete_tax)[0]["taxon_name"]
+            name = record["taxon_name"]
     except:
-        name = str(int(tax_id))
+        name = str(query_id)
 
     return name
 
-def get_taxname_from_dmp(data, tax_id, tax_level):
+def fetch_taxonomy_record(query_id):
+    if query_id not in unipept_cache:
+        path = UNIPEPT_TAXONOMY + '?input[]=' + query_id + '&extra=true&names=true'
+        complete_tax = SESSION.get(path, timeout=UNIPEPT_TIMEOUT).text
+        try:
+            unipept_cache[query_id] = json.loads(complete_tax)[0]
+        except:
+            pass
+
+def get_taxnames(tax_ids,tax_level):
+    #Resolves all tax ids with a single Unipept request instead of one request per id
+    tax_level_tag = UNIPEPT_TAGS[tax_level]
+    #Avoids pipeline crash due to "nan" classification output, looked up as the root taxon. Thanks to Qi-Maria from Github
+    query_ids = {tax_id: str(1 if pd.isna(tax_id) else int(tax_id)) for tax_id in tax_ids}
+
+    missing = sorted(set(query_ids.values()) - set(unipept_cache), key=int)
+    if missing:
+        params = [('input[]', query_id) for query_id in missing] + [('extra', 'true'), ('names', 'true')]
+        try:
+            response = SESSION.post(UNIPEPT_TAXONOMY, data=params, timeout=UNIPEPT_TIMEOUT)
+            response.raise_for_status()
+            for record in response.json():
+                unipept_cache[str(record["taxon_id"])] = record
+        except:
+            pass
+        #ids the batch did not return, or all of them if it was rejected, are retried
+        #with single-id requests overlapped on a thread pool
+        unanswered = [query_id for query_id in missing if query_id not in unipept_cache]
+        if unanswered:
+            with ThreadPoolExecutor(max_workers=UNIPEPT_WORKERS) as executor:
+                for future in [executor.submit(fetch_taxonomy_record, query_id) for query_id in unanswered]:
+                    try:
+                        future.result()
+                    except:
+                        pass
+
+    return {tax_id: name_from_record(unipept_cache.get(query_id), tax_level_tag, query_id) for tax_id, query_id in query_ids.items()}
+
+def get_dmp_lookup(data):
+    #Index the classification table by taxid once, keeping the first row of each taxid
+    columns = [column for column in ("species", "genus", "family", "order", "name", "sciname") if column in data.columns]
+    return data.drop_duplicates('taxid').set_index('taxid')[columns].to_dict('index')
+
+def get_taxname_from_dmp(lookup, tax_id, tax_level):
     tags = {"S": "species","G": "genus","F": "family", "O": "order"}
     tax_level_tag = tags[tax_level]
 
-    if str(tax_id) == "nan":
-        name = 'unclassified'
-    else:
-        name = data.loc[data['taxid'] == tax_id, tax_level_tag].iloc[0]
-        if type(name) != str:
-            name = data.loc[data['taxid'] == tax_id, "name"].iloc[0]
-            if type(name) != str:
-                name = data.loc[data['taxid'] == tax_id, "sciname"].iloc[0]
+    if pd.isna(tax_id):
+        return 'unclassified'
+
+    #returns None, leaving the taxid to Unipept, when the classification table lacks the taxid
+    #or the column to name it from (blast tables only carry sciname, not the rank columns)
+    record = lookup.get(tax_id, {})
+    for column in (tax_level_tag, "name", "sciname"):
+        if column not in record:
+            return None
+        name = record[column]
+        if type(name) == str:
+            break
 
     return name
 
@@ -46,84 +131,88 @@ def get_taxname_from_dmp(data, tax_id, tax_level):
 def get_abundance_values(names,paths):
     dfs = []
     for name,path in zip(names,paths):
-        data1 = pd.read_csv(path, index_col=False, sep=';').iloc[:,1:]
+        #the leading id column is never used, so it is skipped while parsing
+        data1 = pd.read_csv(path, index_col=False, sep=';', usecols=lambda column: column != 'id', dtype={'reads_in_cluster': 'int64'})
 
-        total = sum(data1['reads_in_cluster'])
-        rel_abundance=[]
+        total = data1['reads_in_cluster'].sum()
 
         data=choose_classification(data1)
+        #nullable integer ids hash and group as integers, missing ids stay as <NA>
+        data['taxid'] = data['taxid'].astype('Int64')
 
-        for index,row in data.iterrows():
-            rel_abundance.append(row['reads_in_cluster'] / total * 100)
-            
-        data['rel_abundance'] = rel_abundance
-        dfs.append(pd.DataFrame({'taxid': data['taxid'], 'rel_abundance': rel_abundance, 'reads': data['reads_in_cluster']}))
-        data.to_csv("" + name + "_nanoclust_out.txt")
+        data['rel_abundance'] = data['reads_in_cluster'] / total * 100
+        dfs.append(data[['taxid', 'rel_abundance', 'reads_in_cluster']].rename(columns={'reads_in_cluster': 'reads'}))
+        data.to_csv(name + "_nanoclust_out.txt", index=False)
 
     return dfs, data
 
 def choose_classification(dataframe):
-    print(dataframe)
-    if len(dataframe.columns)>13:
-        chosen_frame=[]
-        classification_score={}
-        for index, row in dataframe.iterrows():
-            print(row['class_level'])
-            if row['class_level']=="S":
-                chosen_frame.append(row.iloc[:12].tolist())
-            else:
-                classification_score["kraken2"]=sum(row.notna()[8:12])
-                classification_score["blast"]=sum(row.notna()[24:])
-                classification_score["seqmatch"]=sum(row.notna()[16:20])
-                choice=max(classification_score, key=classification_score.get)
-                
-                if choice == "kraken2":
-                    chosen_frame.append(row.iloc[:12].tolist())
-                elif choice == "seqmatch":
-                    chosen_frame.append(row.iloc[np.r_[0:4,13:20]].tolist())
-                else:
-                    chosen_frame.append(row.iloc[np.r_[0:4,20:28]].tolist())
-            
-        print("choosing classification")
-
-        print(chosen_frame)
-        chosen_df=pd.DataFrame(chosen_frame, columns=['reads_in_cluster', 'used_for_consensus', 'reads_after_corr', 'draft_id', 'classifier_name', 'taxid', 'stat', 'name', 'species', 'genus', 'family', 'order'])
-        print(len(chosen_df))
-        print(chosen_df)
-    # renamed_df=chosen_df.rename(columns={chosen_df.columns[5]: 'taxid'})
-    # print(renamed_df)
-
-        return chosen_df
-    else:
+    logger.debug("%s", dataframe)
+    #single-classifier tables already carry one classification per row
+    if len(dataframe.columns)<=13:
         return dataframe
 
-def merge_abundance(dfs, data, tax_level):
-    df_final = reduce(lambda left,right: pd.merge(left,right,on='taxid',how='outer').fillna(0), dfs)
-    all_tax=[]
-    for index, row in df_final.iterrows():
-        try:
-            all_tax.append(get_taxname_from_dmp(data, row["taxid"], tax_level))
-        except:
-            all_tax.append(get_taxname(row["taxid"], tax_level))
-    df_final["taxid"] = all_tax
-    #df_final["taxid"] = [get_taxname(row["taxid"], tax_level) for index, row in df_final.iterrows()]
-    df_final_grp = df_final.groupby(["taxid"], as_index=False).sum()
+    columns=['reads_in_cluster', 'used_for_consensus', 'reads_after_corr', 'draft_id', 'classifier_name', 'taxid', 'stat', 'name', 'species', 'genus', 'family', 'order']
+    n_rows=len(dataframe)
+
+    #candidate rows from each classifier, sharing the four leading cluster columns
+    kraken2=dataframe.iloc[:,:12].to_numpy(dtype=object)
+    seqmatch=dataframe.iloc[:,np.r_[0:4,12:20]].to_numpy(dtype=object)
+    blast=dataframe.iloc[:,np.r_[0:4,20:28]].to_numpy(dtype=object)
+
+    #same order as the former score dict so ties still resolve kraken2, blast, seqmatch
+    present=dataframe.notna().to_numpy()
+    classification_score=np.column_stack([
+        present[:,8:12].sum(axis=1),
+        present[:,24:].sum(axis=1),
+        present[:,16:20].sum(axis=1)])
+    choice=classification_score.argmax(axis=1)
+    choice[(dataframe['class_level']=="S").to_numpy()]=0
+
+    logger.debug("choosing classification")
+
+    chosen_frame=np.stack([kraken2, blast, seqmatch])[choice, np.arange(n_rows)]
+    chosen_df=pd.DataFrame(chosen_frame, columns=columns).infer_objects()
+    logger.debug("%d rows classified", len(chosen_df))
+    logger.debug("%s", chosen_df)
+
+    return chosen_df
+
+def resolve_taxnames(tax_ids, lookup, tax_level):
+    #Names each distinct taxid once, from the classification table when possible
+    all_tax={tax_id: get_taxname_from_dmp(lookup, tax_id, tax_level) for tax_id in tax_ids}
+    unresolved=[tax_id for tax_id, name in all_tax.items() if name is None]
+    #ids missing from the classification table are sent to Unipept in one batch
+    all_tax.update(get_taxnames(unresolved, tax_level))
+    return all_tax
+
+def merge_abundance(dfs, lookup, tax_level):
+    #a single barcode is the usual case and needs no concatenation
+    df_final = dfs[0] if len(dfs) == 1 else pd.concat(dfs, ignore_index=True)
+    #assign rather than overwrite in place, the per-sample frames are reused for every tax level
+    #missing ids get code -1, which picks the trailing <NA> entry
+    codes, tax_ids = pd.factorize(df_final["taxid"])
+    tax_ids = list(tax_ids) + [pd.NA]
+    all_tax = resolve_taxnames(tax_ids, lookup, tax_level)
+    tax_names = np.array([all_tax[tax_id] for tax_id in tax_ids], dtype=object)[codes]
+    df_final = df_final.assign(taxid=pd.Categorical(tax_names))
+    df_final_grp = df_final.groupby("taxid", as_index=False, observed=True).agg({'rel_abundance': 'sum', 'reads': 'sum'})
     df_final_sorted = df_final_grp.sort_values(by='rel_abundance', ascending=False)
     return df_final_sorted
 
-def get_abundance(names,paths,tax_level):
+def get_abundance(names,paths,tax_levels):
     if(not isinstance(paths, list)):
         paths = [paths]
         names = [names]
 
+    #tables are read, classified and indexed once and shared by every tax level
     dfs, data = get_abundance_values(names,paths)
-    df_final_grp = merge_abundance(dfs, data, tax_level)
-    df_final_grp.to_csv("rel_abundance_"+ names[0] + "_" + tax_level + ".csv", index = False)
+    lookup = get_dmp_lookup(data)
+    for tax_level in tax_levels:
+        df_final_grp = merge_abundance(dfs, lookup, tax_level)
+        df_final_grp.to_csv("rel_abundance_"+ names[0] + "_" + tax_level + ".csv", index = False)
 
 paths = "$table"
 names = "$barcode"
 
-get_abundance(names,paths, "G")
-get_abundance(names,paths, "S")
-get_abundance(names,paths, "O")
-get_abundance(names,paths, "F")
\ No newline at end of file
+get_abundance(names,paths, ["G", "S", "O", "F"])
\ No newline at end of file